@@ -1,69 +1,140 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import argparse
+import hashlib
+import json
+import mmap
 import os
 import re
-from operator import attrgetter
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-import psycopg2
 import yaml
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+# .sql files smaller than this are read in one call rather than memory-mapped,
+# since mapping a small file costs more than reading it.
+MMAP_MIN_FILE_SIZE = 64 * 1024
+
+
+# Bump this whenever parse_statement's output changes, so that stale cached
+# parses are ignored.
+PARSE_CACHE_VERSION = 9
+
+
+# The default number of queued statements to send to Redshift in each round
+# trip.
+DEFAULT_SQL_BATCH_SIZE = 100
+
+
+# Matches one statement in the raw bytes of a .sql file, along with the
+# comment lines above it. Statements end at the next ';' that isn't quoted or
+# in a comment. Every statement is matched (not just create statements), and
+# an unterminated quote or comment runs to the end of the file, so the loop
+# never backtracks and each ';' starts exactly one linear match.
+SQL_FILE_STATEMENT_RE = re.compile(
+    rb"(?P<statement>"
+    rb"""(?:[^;'"$/-]+"""         # Matches everything up to the next ';',
+    rb"|'(?:[^']|'')*(?:'|\Z)"    # skipping over quoted strings,
+    rb'|"(?:[^"]|"")*(?:"|\Z)'    # quoted identifiers,
+    rb"|\$\$.*?(?:\$\$|\Z)"       # $$-quoted function bodies,
+    rb"|--[^\n]*"                 # -- comments
+    rb"|/\*.*?(?:\*/|\Z)"         # and /* block comments */
+    rb"|[$/-])*);?",              # Matches the ';' itself
+    re.S)                         # Multi-line matching.
+
+
+# Matches the start of a create statement, after the comment lines above it.
+SQL_CREATE_PREFIX_RE = re.compile(
+    rb"(?:\s*--[^\n]*(?:\n|\Z))*"  # Matches whole comment lines
+    rb"\s*create\s",               # Matches 'create'
+    re.I)                          # Case insensitive matching.
+
+
+# Matches a comment line or an empty line, including its line break.
+SQL_COMMENT_LINE_RE = re.compile(
+    r'^(?:[^\S\r\n]*--[^\n]*)?'   # Matches an optional '--' comment
+    r'(?:\r?\n|\Z)',              # Matches the end of the line
+    re.M)                         # Multi-line matching.
+
+
+# Matches the comment lines (and empty lines) above a declaration.
+SQL_LEADING_COMMENTS_RE = re.compile(
+    r'\A(?:[^\S\n]*'             # Matches leading whitespace,
+    r'(?:--[^\n]*)?\n)*')         # an optional comment and the line break
 
-# Matches a view or function definition
-SQL_VIEW_STATEMENT_RE = re.compile(
-    r'(?P<declaration>'
-    'create\s+(or replace\s+)?'  # Matches 'create [or replace]'
-    '(?P<type>view)\s+'          # Matches the 'view' keyword
-    '(?P<name>\w+)'              # Matches the name of the view
-    '.+?(?=as)'                  # Matches everything before the next 'as'
-    'as)(?P<body>.*)',           # Matches 'as', followed by the view body
-    re.I | re.S | re.M)          # Case insensitive, multi-line matching.
 
+# Matches the text of a comment, without its dashes or leading whitespace.
+SQL_COMMENT_TEXT_RE = re.compile(r'--[- \t]*([^\r\n]*)')
 
-SQL_FUNCTION_STATEMENT_RE = re.compile(
+
+# Matches a character that can be part of an unquoted identifier.
+SQL_IDENTIFIER_CHARACTER_RE = re.compile(r'\w')
+
+
+# Matches the declaration of a view or function. The statement's body is
+# everything after the match.
+SQL_STATEMENT_RE = re.compile(
     r'(?P<declaration>'
-    'create\s+(or replace\s+)?'  # Matches 'create [or replace]'
-    '(?P<type>function)\s+'      # Matches the 'function' keyword
-    '(?P<name>\w+)\s*'           # Matches the name of the function
-    '(?P<arg_list>\(.*\))'       # Matches the function's argument list
-    '[^)]+?(?=returns)'          # Matches everything before the word 'returns'
-    'returns.+?(?=as)'           # Matches everything before the word 'as'
-    'as\s+\$\$)'                 # Matches 'as $$'
-    '(?P<body>.*)',              # Matches everything else in the statement
-    re.I | re.S | re.M)          # Case insensitive, multi-line matching.
+    r'create\s+(or replace\s+)?'  # Matches 'create [or replace]'
+    r'(?:(?P<view>view)\s+'       # For views, matches the 'view' keyword,
+    r'(?P<view_name>\w+)\b'       # the name of the view
+    r'.+?\bas\b'                  # and everything up to the next 'as'
+    r'|(?P<function>function)\s+'  # For functions, matches 'function',
+    r'(?P<function_name>\w+)\s*'  # the name of the function,
+    r'(?P<arg_list>\([^()]*'      # the function's argument list (allowing
+    r'(?:\([^()]*\)[^()]*)*\))'   # types like numeric(18, 2)),
+    r'[^)]*?\breturns\b'          # everything up to 'returns'
+    r'.+?\bas\s+\$\$))',          # and everything up to 'as $$'
+    re.I | re.S | re.M)           # Case insensitive, multi-line matching.
 
 
 class RoomWithAViewCommand(object):
     help = '''Manages Redshift SQL views.'''
 
+    # Maps each action to its description and the name of its handler method.
+    actions = {
+        'sync': ('Syncs specific views or functions (identified by the '
+                 '--view-names or --file-names parameters).',
+                 'sync_views'),
+        'sync-all': ('Syncs all views and functions in all .sql files in '
+                     'a set of directories (identified by the '
+                     '--directories parameter). The directory will be '
+                     'searched recursively.',
+                     'sync_all'),
+        'drop': ('Drops specific views or functions (identified by the '
+                 '--view-names or --file-names parameters).',
+                 'drop_views'),
+        'drop-all': ('Drops all views and functions in all .sql files in '
+                     'a set of directories (identified by the '
+                     '--directories parameter). The directory will be '
+                     'searched recursively.',
+                     'drop_all'),
+        'list': ('lists all known views and functions.', 'list_all'),
+    }
+    actions_help = 'Possible actions:\n\t{}'.format(
+        '\n\t'.join(['{}: {}'.format(action, description)
+                     for action, (description, _) in actions.items()]))
+
     def __init__(self):
-        self.actions = {
-            'sync': ('Syncs specific views or functions (identified by the '
-                     '--view-names or --file-names parameters).',
-                     self.sync_views),
-            'sync-all': ('Syncs all views and functions in all .sql files in '
-                         'a set of directories (identified by the '
-                         '--directories parameter). The directory will be '
-                         'searched recursively.',
-                         self.sync_all),
-            'drop': ('Drops specific views or functions (identified by the '
-                     '--view-names or --file-names parameters).',
-                     self.drop_views),
-            'drop-all': ('Drops all views and functions in all .sql files in '
-                         'a set of directories (identified by the '
-                         '--directories parameter). The directory will be '
-                         'searched recursively.',
-                         self.drop_all),
-            'list': ('lists all known views and functions.', self.list_all),
-        }
+        self.pending_sql = []
+        self.parsed_files = {}  # real path -> statements parsed from it
+        self.existing_functions = None  # see get_existing_functions()
 
     def parse_args(self):
-        actions_help = 'Possible actions:\n\t{}'.format(
-            '\n\t'.join(['{}: {}'.format(action, description)
-                         for action, (description, _)
-                         in self.actions.items()]))
         parser = argparse.ArgumentParser(
-            description='{} {}'.format(self.help, actions_help),
+            description='{} {}'.format(self.help, self.actions_help),
             formatter_class=argparse.RawDescriptionHelpFormatter)
         parser.add_argument('action', type=str, choices=self.actions.keys(),
                             help='The action to perform.')
@@ -84,6 +155,18 @@ class RoomWithAViewCommand(object):
                             default='settings.yaml', help=(
                                 'Location of the settings file (settings.yaml '
                                 'by default)'))
+        parser.add_argument('--no-cache', action='store_true', help=(
+            'Parse every .sql file instead of reusing parses cached from '
+            'previous runs for files that haven\'t changed'))
+        parser.add_argument('--batch-size', type=int, required=False,
+                            default=DEFAULT_SQL_BATCH_SIZE, help=(
+                                'Number of statements to send to Redshift in '
+                                'each round trip ({} by default). 0 sends '
+                                'all statements in a single round trip.'
+                                .format(DEFAULT_SQL_BATCH_SIZE)))
+        parser.add_argument('--dry-run', action='store_true', help=(
+            'Print the SQL that would be run to drop and create views and '
+            'functions, without running it'))
         parser.add_argument('--verbosity', type=int, required=False, default=1,
                             help=('Verbosity of script output. 0 will output '
                                   'nothing, 1 will output names of views and '
@@ -93,70 +176,243 @@ class RoomWithAViewCommand(object):
 
         try:
             with open(self.options.settings, 'r') as stream:
-                settings = yaml.safe_load(stream)
-                connection_options = settings['connections'].get(
-                    self.options.connection)
-                if not connection_options:
-                    raise ValueError('Unrecognized connection name: {}'.format(
-                        self.options.connection))
-                self.conn = psycopg2.connect(**connection_options)
-                self.directories = settings['directories']
-        except Exception as e:
+                settings = yaml.load(stream, Loader=YamlLoader)
+            connection_options = settings['connections'].get(
+                self.options.connection)
+            self.directories = settings['directories']
+        except (OSError, yaml.YAMLError, KeyError, TypeError,
+                AttributeError) as e:
             raise ValueError('Unable to read settings.yaml: {}'.format(str(e)))
+        if not connection_options:
+            raise ValueError('Unrecognized connection name: {}'.format(
+                self.options.connection))
+
+        # psycopg2 is slow to import, so we only import it once we know we
+        # need a connection (and not for --help or bad arguments).
+        import psycopg2
+        self.conn = psycopg2.connect(**connection_options)
+        # Everything runs in one transaction, committed by handle().
+        self.conn.autocommit = False
+        self.cache_path = None if self.options.no_cache else (
+            self.get_cache_path())
 
     def handle(self):
         try:
             self.parse_args()
+            # All SQL runs through one cursor, which closing the connection
+            # also closes.
+            self.cursor = self.conn.cursor()
             self.dependency_graph = self.parse_dependency_graph()
-            handler = self.actions[self.options.action][1]
+            if self.options.action != 'list':
+                # Look up which functions exist before any DDL is queued, so
+                # that the lookup doesn't flush the queue part way through.
+                self.get_existing_functions()
+            handler = getattr(self, self.actions[self.options.action][1])
             handler()
-            self.conn.commit()
+            self.flush_sql()
+            if not self.options.dry_run:
+                self.conn.commit()
         finally:
             if hasattr(self, 'conn'):
                 self.conn.close()
 
     def list_all(self):
-        sorted_graph = sorted(
-            self.dependency_graph.values(), key=attrgetter('name'))
+        # The graph is keyed by name, so sort the names themselves.
         print('Known views and functions:\n\n{}'.format('\n\n'.join([
-            str(node) for node in sorted_graph])))
+            str(self.dependency_graph[name])
+            for name in sorted(self.dependency_graph)])))
 
     def get_statements_from_file(self, filename):
-        dependency_graph = {}
-        self.parse_file(filename, dependency_graph)
-        return dependency_graph.keys()
+        # Files under the configured directories were already parsed while
+        # building the dependency graph, so don't parse them again.
+        statements = self.parsed_files.get(os.path.realpath(filename))
+        if statements is None:
+            statements = self.parse_file_statements(filename)
+        return [statement_data['name'] for statement_data in statements]
+
+    def parse_file_statements(self, filename):
+        """ Returns the data of each view or function defined in a file.
+
+        Large files are memory-mapped, and all files are searched as bytes,
+        so that only the create statements in them are decoded into strings.
+        """
+        with open(filename, 'rb') as sql_file:
+            file_size = os.fstat(sql_file.fileno()).st_size
+            if file_size < MMAP_MIN_FILE_SIZE:
+                # This includes empty files, which can't be memory-mapped.
+                return self.parse_sql_contents(sql_file.read())
+            with mmap.mmap(sql_file.fileno(), 0,
+                           access=mmap.ACCESS_READ) as sql_contents:
+                return self.parse_sql_contents(sql_contents)
+
+    def parse_sql_contents(self, sql_contents):
+        statements = []
+        for match in SQL_FILE_STATEMENT_RE.finditer(sql_contents):
+            if not SQL_CREATE_PREFIX_RE.match(sql_contents, match.start()):
+                continue
+            # Normalize Windows line endings, so that bodies and declarations
+            # only ever contain '\n' line breaks.
+            statement_data = self.parse_statement(
+                match.group('statement').decode('utf-8').replace('\r\n', '\n'))
+            if statement_data['name'] is not None:
+                statements.append(statement_data)
+        return statements
 
-    def parse_file(self, filename, dependency_graph):
-        with open(filename, 'r') as sql_file:
-            sql_contents = sql_file.read()
+    def get_sql_filenames(self):
+        for directory in self.directories:
+            yield from self.iter_sql_filenames(directory)
 
-        for statement in sql_contents.split(';'):
-            statement_data = self.parse_statement(statement)
-            if statement_data['name'] is not None:
-                dependency_graph[statement_data['name']] = DependencyGraphNode(
-                    **statement_data)
+    def iter_sql_filenames(self, directory):
+        """ Yields the paths of all .sql files in a directory, recursively.
+
+        Files are yielded in the same order as ``os.walk``, but ``os.scandir``
+        entries let us tell files from directories without another ``stat``.
+        """
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif (entry.name[-4:].lower() == '.sql' and
+                          entry.is_file()):
+                        yield entry.path
+        except OSError:
+            return  # like os.walk, skip directories we can't list
+        for subdirectory in subdirectories:
+            yield from self.iter_sql_filenames(subdirectory)
 
     def parse_dependency_graph(self):
+        """ Parses all .sql files in the directories into a dependency graph.
+
+        Parsed statements are cached on disk for each file, keyed by the
+        file's modification time and size, so that only files that changed
+        since the last run are read and parsed again. Those files are read
+        and parsed on a thread pool, so that reading one file overlaps with
+        parsing another.
+        """
+        cached_files = self.load_parse_cache()
+        fingerprints = {}
+        changed_filenames = []
+        for filename in self.get_sql_filenames():
+            file_stat = os.stat(filename)
+            fingerprints[filename] = [file_stat.st_mtime_ns, file_stat.st_size]
+            cached_file = cached_files.get(filename)
+            if (not cached_file or
+                    cached_file['fingerprint'] != fingerprints[filename]):
+                changed_filenames.append(filename)
+
+        max_workers = min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            changed_statements = dict(zip(changed_filenames, executor.map(
+                self.parse_file_statements, changed_filenames)))
+
+        # Merge the parsed files in directory order, so that if a name is
+        # defined twice, the last definition wins as it always has.
+        parsed_files = {}
         dependency_graph = {}
-        for directory in self.directories:
-            for root, dirs, files in os.walk(directory):
-                for basename in files:
-                    if not basename.lower().endswith('.sql'):
-                        continue
-                    filename = os.path.join(root, basename)
-                    self.parse_file(filename, dependency_graph)
-
-        statement_names = dependency_graph.keys()
+        for filename, fingerprint in fingerprints.items():
+            if filename in changed_statements:
+                statements = changed_statements[filename]
+            else:
+                statements = cached_files[filename]['statements']
+            parsed_files[filename] = {
+                'fingerprint': fingerprint,
+                'statements': statements,
+            }
+            self.parsed_files[os.path.realpath(filename)] = statements
+            for statement_data in statements:
+                # Names are referenced from many edge sets, so share a single
+                # copy of each.
+                statement_data['name'] = sys.intern(statement_data['name'])
+                dependency_graph[statement_data['name']] = DependencyGraphNode(
+                    **statement_data)
+        if parsed_files != cached_files:
+            self.save_parse_cache(parsed_files)
+
+        find_statement_names = self.get_statement_name_finder(
+            tuple(dependency_graph))
         for node in dependency_graph.values():
-            dependencies = self.get_dependencies(
-                node.name, node.body, statement_names)
-            node.out_edges |= set(dependencies)
+            dependencies = set(find_statement_names(node.body)) - {node.name}
+            node.out_edges |= dependencies
             for dependency in dependencies:
                 dependency_graph[dependency].in_edges.add(node.name)
+
+        # The graph doesn't change from here on, so freeze the edges. Sorting
+        # the in-edges also makes traversals visit dependents in the same
+        # order on every run.
+        for node in dependency_graph.values():
+            node.in_edges = tuple(sorted(node.in_edges))
+            node.out_edges = frozenset(node.out_edges)
+        self.check_for_cycles(dependency_graph)
         return dependency_graph
 
+    def check_for_cycles(self, graph):
+        """ Raises a ValueError describing a dependency cycle, if there is one.
+
+        Kahn's algorithm never orders a node that is on a cycle or depends on
+        one, and each such node has a dependency that also wasn't ordered. So
+        following unordered dependencies from any unordered node must
+        eventually revisit a node, and the nodes in between form a cycle.
+        """
+        unordered_names = set(graph) - {
+            node.name for node in self.get_dependency_order(graph)}
+        if not unordered_names:
+            return
+
+        path = []
+        path_indexes = {}
+        node_name = min(unordered_names)
+        while node_name not in path_indexes:
+            path_indexes[node_name] = len(path)
+            path.append(node_name)
+            node_name = min(edge for edge in graph[node_name].out_edges
+                            if edge in unordered_names)
+        cycle = path[path_indexes[node_name]:] + [node_name]
+        raise ValueError(
+            'Circular dependency between views or functions (each depends '
+            'on the next): {}'.format(' -> '.join(cycle)))
+
+    def get_cache_path(self):
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache')
+        directories_key = hashlib.sha1('\n'.join(
+            os.path.abspath(directory) for directory in self.directories
+        ).encode('utf-8')).hexdigest()
+        return os.path.join(cache_home, 'room_with_a_view',
+                            '{}.json'.format(directories_key))
+
+    def load_parse_cache(self):
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            return {}  # no usable cache, so parse everything
+        if cache.get('version') != PARSE_CACHE_VERSION:
+            return {}
+        return cache['files']
+
+    def save_parse_cache(self, parsed_files):
+        if not self.cache_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            # Write to a temporary file first so that concurrent runs never
+            # read a partially written cache.
+            temporary_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
+            with open(temporary_path, 'w') as cache_file:
+                json.dump({'version': PARSE_CACHE_VERSION,
+                           'files': parsed_files}, cache_file)
+            os.replace(temporary_path, self.cache_path)
+        except OSError:
+            pass  # caching is an optimization, so don't fail the command
+
     def get_statements_from_arguments(self):
-        statement_names = self.options.view_names
+        # Copy the names, so that the parsed options (or argparse's default
+        # list) aren't changed when we add the names from files.
+        statement_names = list(self.options.view_names)
         file_names = self.options.file_names
         if not statement_names and not file_names:
             raise ValueError(
@@ -195,97 +451,153 @@ class RoomWithAViewCommand(object):
 
         Since deleting a view will cascade, we have to recreate all views
         dependent on it, in topological order. To identify the order in which
-        views need to be recreated, we build a subgraph consisting of only
-        views that can be reached from the views we're syncing, then recreate
-        the views in topological order on the subgraph using Kahn's algorithm
-        (as we do in ``sync_all()``).
+        views need to be recreated, we find the subgraph of views that can be
+        reached from the views we're syncing, then recreate the views in the
+        subgraph's dependency order (as we do for the whole graph in
+        ``sync_all()``).
         """
         statement_names = self.get_statements_from_arguments()
 
-        # First, build a graph containing only nodes reachable from the views
-        # and functions to sync.
+        # First, find all nodes reachable from the views and functions to
+        # sync.
         starting_nodes = [self.dependency_graph[statement_name]
                           for statement_name in statement_names]
-        subgraph_node_names = self.traverse_graph(starting_nodes,
-                                                  dependency_order=False)
-        subgraph = {}
-        for node_name in subgraph_node_names:
-            original_node = self.dependency_graph[node_name]
-            new_node = DependencyGraphNode(
-                name=original_node.name,
-                declaration=original_node.declaration,
-                statement_type=original_node.statement_type,
-                body=original_node.body,
-                comments=original_node.comments,
-                arg_list=original_node.arg_list)
-            subgraph[node_name] = new_node
-            new_node.in_edges = set([edge for edge in original_node.in_edges
-                                     if edge in subgraph_node_names])
-            new_node.out_edges = set([edge for edge in original_node.out_edges
-                                      if edge in subgraph_node_names])
+
+        # If nothing depends on the starting nodes (e.g. when syncing leaf
+        # views), there's no subgraph to recreate.
+        if not any(node.in_edges for node in starting_nodes):
+            for node in starting_nodes:
+                self.drop_and_recreate_node(node)
+            return
+
+        subgraph_node_names = self.traverse_graph(starting_nodes)
 
         # Then, drop all the views and functions.
         for node in starting_nodes:
             self.drop_node(node)
 
-        # Finally, run Kahn's algorithm to recreate the subgraph in dependency
-        # order.
-        starting_nodes = [node for node in subgraph.values()
-                          if not node.out_edges]
-        self.traverse_graph(starting_nodes, graph=subgraph,
-                            visit_function=self.create_node)
+        # Finally, recreate the subgraph in dependency order.
+        for node in self.get_dependency_order(node_names=subgraph_node_names):
+            self.create_node(node)
 
     def sync_all(self):
         """ Syncs all views and functions to Redshift. """
-        starting_nodes = [node for node in self.dependency_graph.values()
-                          if not node.out_edges]
-        self.traverse_graph(
-            starting_nodes, visit_function=self.drop_and_recreate_node)
+        for node in self.get_dependency_order():
+            self.drop_and_recreate_node(node)
 
-    def traverse_graph(self, starting_nodes, graph=None, visit_function=None,
-                       dependency_order=True):
-        """ Traverses a dependency graph and returns the visited nodes' names.
+    def traverse_graph(self, starting_nodes):
+        """ Returns the names of all nodes that depend on the starting nodes.
 
-        This is a breadth first search over the graph.
+        This is a breadth first search over the graph's in-edges.
         :param starting_nodes: the set of nodes from which to run the search.
-        :param graph: the graph to search over.
-        :param visit_function: A function to run at each node visited.
-        :param dependency_order: if True, nodes will be visited in a
-          topological order guaranteed not to violate dependencies. This is
-          enforced using Kahn's algorithm (read more here:
-          https://en.wikipedia.org/wiki/Topological_sorting#Kahn's_algorithm).
-        :returns: A set of visited node names.
+        :returns: A set of visited node names, including the starting nodes.
         """
-        graph = graph or self.dependency_graph
         visited_nodes = set()
-        active_nodes = starting_nodes
+        active_nodes = deque(starting_nodes)
         while active_nodes:
             # Pop a new node off the queue
-            active_node = active_nodes[0]
-            active_nodes = active_nodes[1:]
+            active_node = active_nodes.popleft()
             if active_node.name in visited_nodes:
                 continue
-
-            # Visit the node
             visited_nodes.add(active_node.name)
-            if visit_function:
-                visit_function(active_node)
 
             # Add neighboring nodes to the queue
             for node_name in active_node.in_edges:
-                next_node = graph[node_name]
-                unvisited_dependents = next_node.out_edges - visited_nodes
-                if not dependency_order or not unvisited_dependents:
-                    active_nodes.append(next_node)
+                active_nodes.append(self.dependency_graph[node_name])
         return visited_nodes
 
-    def execute_sql(self, sql_statement):
+    def get_dependency_order(self, graph=None, node_names=None):
+        """ Returns a graph's nodes, each after all of its dependencies.
+
+        The order is found with Kahn's algorithm (read more here:
+        https://en.wikipedia.org/wiki/Topological_sorting#Kahn's_algorithm).
+        Rather than rescanning a node's out-edges each time one of its
+        dependencies is visited, we count each node's unvisited dependencies
+        and queue the node once the count reaches zero.
+        :param graph: the graph to order (the full dependency graph by
+          default).
+        :param node_names: if given, a set of names to restrict the ordering
+          to. Edges to nodes outside of it are ignored, so there's no need to
+          build a separate subgraph.
+        :returns: A list of nodes in a topological order.
+        """
+        if graph is None:
+            graph = self.dependency_graph
+        if node_names is None:
+            unvisited_dependencies = {
+                node_name: len(node.out_edges)
+                for node_name, node in graph.items()}
+        else:
+            unvisited_dependencies = {
+                node_name: len(node.out_edges & node_names)
+                for node_name, node in graph.items()
+                if node_name in node_names}
+        active_nodes = deque(
+            graph[node_name]
+            for node_name, count in unvisited_dependencies.items()
+            if not count)
+        ordered_nodes = []
+        while active_nodes:
+            active_node = active_nodes.popleft()
+            ordered_nodes.append(active_node)
+            for node_name in active_node.in_edges:
+                if node_name not in unvisited_dependencies:
+                    continue  # outside of node_names
+                unvisited_dependencies[node_name] -= 1
+                if not unvisited_dependencies[node_name]:
+                    active_nodes.append(graph[node_name])
+        return ordered_nodes
+
+    def queue_sql(self, sql_statement):
+        """ Queues a statement to be sent to Redshift by ``flush_sql()``. """
+        if self.options.verbosity >= 2 and not self.options.dry_run:
+            print('Executing: {}'.format(sql_statement))
+        self.pending_sql.append(sql_statement)
+
+    def flush_sql(self):
+        """ Sends all queued statements to Redshift, in batches.
+
+        Each batch of ``--batch-size`` statements is sent in a single round
+        trip, rather than one round trip per statement. A batch size of 0
+        sends the whole queue as one multi-statement query. With
+        ``--dry-run``, the statements are printed instead.
+        """
+        if not self.pending_sql:
+            return
+        if self.options.dry_run:
+            # Print each ';' on its own line, so that the output still runs
+            # when a statement ends in a -- comment.
+            for sql_statement in self.pending_sql:
+                print('{}\n;'.format(sql_statement))
+            self.pending_sql = []
+            return
+        from psycopg2.extensions import AsIs
+        from psycopg2.extras import execute_batch
+        if self.options.batch_size <= 0:
+            # Put each ';' on its own line, so that it can't end up inside
+            # a -- comment at the end of the statement before it.
+            self.cursor.execute('\n;\n'.join(self.pending_sql))
+        else:
+            # execute_batch joins each page's statements with a bare ';'.
+            # End every statement with a line break, so that a body ending
+            # in a -- comment doesn't comment out the ';' (and the next
+            # statement).
+            execute_batch(self.cursor, '%s', [
+                (AsIs(sql_statement + '\n'),)
+                for sql_statement in self.pending_sql
+            ], page_size=self.options.batch_size)
+        self.pending_sql = []
+
+    def execute_sql(self, sql_statement, parameters=None):
+        """ Runs a statement right away and returns any resulting rows. """
+        # Queued statements have to run first, since they might change the
+        # result.
+        self.flush_sql()
         if self.options.verbosity >= 2:
             print('Executing: {}'.format(sql_statement))
-        with self.conn.cursor() as cursor:
-            cursor.execute(sql_statement)
-            if cursor.rowcount >= 1:
-                return cursor.fetchall()
+        self.cursor.execute(sql_statement, parameters)
+        if self.cursor.rowcount >= 1:
+            return self.cursor.fetchall()
 
     def drop_node(self, node):
         if self.options.verbosity >= 1:
@@ -294,24 +606,47 @@ class RoomWithAViewCommand(object):
             sql = 'DROP VIEW IF EXISTS {} CASCADE'.format(node.name)
         elif node.statement_type == 'function':
             # There's no 'Drop if exists' for functions in redshift, so we
-            # first look up the function in the system catalog.
-            result = self.execute_sql(
-                "select proname from pg_proc where proname = '{}'"
-                .format(node.name))
-            if not result or result[0] != node.name:
+            # check the system catalog first.
+            existing_functions = self.get_existing_functions()
+            if node.name not in existing_functions:
                 return  # function doesn't exist, no need to drop
 
             sql = 'DROP FUNCTION {} {} CASCADE'.format(
                 node.name, node.arg_list)
+            # Don't drop it again if the name is given twice.
+            existing_functions.discard(node.name)
         else:
             raise ValueError('Unrecognized node type: {}'.format(
                 node.statement_type))
-        self.execute_sql(sql)
+        self.queue_sql(sql)
 
     def create_node(self, node):
         if self.options.verbosity >= 1:
             print('Creating {}: {}'.format(node.statement_type, node.name))
-        self.execute_sql(''.join([node.declaration, node.body]))
+        self.queue_sql(''.join([node.declaration, node.body]))
+        if (node.statement_type == 'function' and
+                self.existing_functions is not None):
+            self.existing_functions.add(node.name)
+
+    def get_existing_functions(self):
+        """ Returns the names of the graph's functions that exist in Redshift.
+
+        All of the graph's functions are looked up in the system catalog with
+        one query, rather than one query per dropped function. ``handle()``
+        calls this before running any action that drops, so that the lookup
+        happens before anything is queued.
+        """
+        if self.existing_functions is None:
+            function_names = tuple(
+                node.name for node in self.dependency_graph.values()
+                if node.statement_type == 'function')
+            rows = None
+            if function_names:
+                rows = self.execute_sql(
+                    'select proname from pg_proc where proname in %s',
+                    (function_names,))
+            self.existing_functions = {row[0] for row in rows or ()}
+        return self.existing_functions
 
     def drop_and_recreate_node(self, node):
         self.drop_node(node)
@@ -324,58 +659,87 @@ class RoomWithAViewCommand(object):
             return statement_data
 
         # Extract comments from above the declaration.
-        statement_lines = [line for line in statement.splitlines() if line]
-        comments = []
-        for line in statement_lines:
-            if line.strip().startswith('--'):
-                comments.append(line.lstrip('- \t'))
-            else:
-                break
-        statement_data['comments'] = ' '.join(comments)
+        leading_comments = SQL_LEADING_COMMENTS_RE.match(statement).group()
+        statement_data['comments'] = ' '.join(
+            SQL_COMMENT_TEXT_RE.findall(leading_comments))
 
-        # remove comments
-        sql_lines = [line for line in statement_lines
-                     if not line.strip().startswith('--')]
-        if not sql_lines:
+        # Remove comments
+        raw_statement = SQL_COMMENT_LINE_RE.sub('', statement).rstrip('\r\n')
+        if not raw_statement:
             return statement_data
 
         # Find view or function declarations
-        raw_statement = '\n'.join(sql_lines)
-        match = SQL_VIEW_STATEMENT_RE.fullmatch(raw_statement)
+        match = SQL_STATEMENT_RE.match(raw_statement)
         if not match:
-            match = SQL_FUNCTION_STATEMENT_RE.fullmatch(raw_statement)
-            if not match:
-                return statement_data
+            return statement_data
+        statement_type = match.group('view') or match.group('function')
         statement_data.update({
-            'statement_type': match.group('type').lower(),
-            'name': match.group('name'),
+            'statement_type': statement_type.lower(),
+            'name': match.group('view_name') or match.group('function_name'),
             'declaration': match.group('declaration'),
-            'body': match.group('body'),
+            'body': raw_statement[match.end():],
+            'arg_list': match.group('arg_list'),
         })
-        statement_data['arg_list'] = (
-            match.group('arg_list')
-            if statement_data['statement_type'] == 'function' else None)
         return statement_data
 
-    def get_dependencies(self, cur_statement_name, cur_statement_body,
-                         all_statement_names):
-        return [statement_name for statement_name in all_statement_names
-                if statement_name in cur_statement_body
-                and statement_name != cur_statement_name]
+    def get_statement_name_finder(self, all_statement_names):
+        """ Builds a function that finds known statement names in a body.
+
+        All names are searched for in a single pass over the body, rather than
+        one pass per name. If ``pyahocorasick`` is installed, we use an
+        Aho-Corasick automaton; otherwise we fall back to one combined regular
+        expression. Names only match as whole identifiers, so ``orders``
+        isn't found in ``select * from daily_orders``.
+        :param all_statement_names: the names of all views and functions.
+        :returns: A function that takes a SQL body and returns an iterable of
+          the statement names found in it.
+        """
+        if not all_statement_names:
+            return lambda body: []
+
+        if ahocorasick is not None:
+            automaton = ahocorasick.Automaton()
+            for statement_name in all_statement_names:
+                automaton.add_word(statement_name, statement_name)
+            automaton.make_automaton()
+
+            def find_statement_names(body):
+                for end, statement_name in automaton.iter(body):
+                    start = end - len(statement_name) + 1
+                    # Slicing returns '' past the end of the body.
+                    before = body[start - 1:start] if start else ''
+                    after = body[end + 1:end + 2]
+                    if not (SQL_IDENTIFIER_CHARACTER_RE.match(before) or
+                            SQL_IDENTIFIER_CHARACTER_RE.match(after)):
+                        yield statement_name
+            return find_statement_names
+
+        statement_names_re = re.compile(r'\b(?:{})\b'.format('|'.join(
+            re.escape(statement_name) for statement_name
+            in sorted(all_statement_names, key=len, reverse=True))))
+        return statement_names_re.findall
 
 
 class DependencyGraphNode(object):
-    def __init__(self, **kwargs):
+    __slots__ = ('name', 'declaration', 'statement_type', 'body', 'comments',
+                 'arg_list', 'in_edges', 'out_edges')
+
+    def __init__(self, name, declaration, statement_type, body, comments,
+                 arg_list=None):
+        self.name = name
+        self.declaration = declaration
+        self.statement_type = statement_type
+        self.body = body
+        self.comments = comments
+        self.arg_list = arg_list
         self.in_edges = set()  # views that depend on this view
         self.out_edges = set()  # views that this view depends on
-        for k, v in kwargs.items():
-            setattr(self, k, v)
 
     def __repr__(self):
         description = '\n\t'.join([
             'description: {}'.format(self.comments),
-            'depends on: {}'.format(', '.join(self.out_edges)),
-            'depended on by: {}'.format(', '.join(self.in_edges))])
+            'depends on: {}'.format(', '.join(sorted(self.out_edges))),
+            'depended on by: {}'.format(', '.join(sorted(self.in_edges)))])
         return '{} {}:\n\t{}'.format(
             self.statement_type.title(), self.name, description)
 
@@ -3,6 +3,9 @@
 
 """Tests for `room_with_a_view` package."""
 
+import argparse
+
+import psycopg2.extras
 import pytest
 
 from room_with_a_view import room_with_a_view
@@ -31,3 +34,495 @@ def test_command_line_interface():
     # Need an 'action' argument on the command-line.
     with pytest.raises(SystemExit):
         command.handle()
+
+
+@pytest.mark.parametrize('use_ahocorasick', [True, False])
+def test_get_statement_name_finder(monkeypatch, use_ahocorasick):
+    """Test finding the statement names used in a statement's body."""
+    if not use_ahocorasick:
+        monkeypatch.setattr(room_with_a_view, 'ahocorasick', None)
+    elif room_with_a_view.ahocorasick is None:
+        pytest.skip('pyahocorasick is not installed')
+    command = room_with_a_view.RoomWithAViewCommand()
+    find_statement_names = command.get_statement_name_finder(
+        ['orders', 'daily_orders', 'customers'])
+
+    assert set(find_statement_names(
+        'select * from daily_orders join public.customers')) == {
+            'daily_orders', 'customers'}
+    assert set(find_statement_names('orders')) == {'orders'}
+    assert set(find_statement_names('select * from orders_2018')) == set()
+
+
+def build_graph(dependencies):
+    """Builds a dependency graph from a dict of name -> dependency names."""
+    graph = {name: room_with_a_view.DependencyGraphNode(
+        name=name, declaration='', statement_type='view', body='',
+        comments='')
+        for name in dependencies}
+    for name, out_edges in dependencies.items():
+        graph[name].out_edges |= set(out_edges)
+        for out_edge in out_edges:
+            graph[out_edge].in_edges.add(name)
+    return graph
+
+
+DEPENDENCIES = {
+    'a': [],
+    'b': ['a'],
+    'c': ['a', 'b'],
+    'd': ['c'],
+    'e': [],
+}
+
+
+def test_get_dependency_order():
+    """Test that nodes are ordered after all of their dependencies."""
+    command = room_with_a_view.RoomWithAViewCommand()
+    command.dependency_graph = build_graph(DEPENDENCIES)
+    ordered = [node.name for node in command.get_dependency_order()]
+
+    assert sorted(ordered) == sorted(DEPENDENCIES)
+    for name, dependencies in DEPENDENCIES.items():
+        for dependency in dependencies:
+            assert ordered.index(dependency) < ordered.index(name)
+
+    ordered = [node.name for node in command.get_dependency_order(
+        node_names={'b', 'c', 'd'})]
+    assert ordered == ['b', 'c', 'd']
+
+
+def test_traverse_graph():
+    """Test finding everything that depends on a set of nodes."""
+    command = room_with_a_view.RoomWithAViewCommand()
+    command.dependency_graph = build_graph(DEPENDENCIES)
+    graph = command.dependency_graph
+
+    assert command.traverse_graph([graph['b']]) == {'b', 'c', 'd'}
+    assert command.traverse_graph([graph['d'], graph['e']]) == {'d', 'e'}
+
+
+SQL_FILE_CONTENTS = '''
+-- All of the orders.
+create view orders as
+select * from raw_orders;
+
+grant select on orders to analyst;
+
+-- Big orders.
+-- Only the big ones.
+CREATE OR REPLACE VIEW big_orders AS
+select * from orders
+-- Anything over 100.
+where total > 100;
+
+create function double_it (integer)
+returns integer stable as $$
+  select $1 * 2
+$$ language sql
+'''
+
+
+def test_parse_file(tmpdir):
+    """Test parsing the views and functions in a .sql file."""
+    sql_file = tmpdir.join('views.sql')
+    sql_file.write(SQL_FILE_CONTENTS)
+    command = room_with_a_view.RoomWithAViewCommand()
+    graph = {statement_data['name']: room_with_a_view.DependencyGraphNode(
+        **statement_data)
+        for statement_data in command.parse_file_statements(str(sql_file))}
+
+    assert sorted(graph) == ['big_orders', 'double_it', 'orders']
+    assert graph['orders'].comments == 'All of the orders.'
+    assert graph['orders'].statement_type == 'view'
+    assert graph['big_orders'].comments == 'Big orders. Only the big ones.'
+    assert 'Anything over 100' not in graph['big_orders'].body
+    assert 'where total > 100' in graph['big_orders'].body
+    assert graph['double_it'].statement_type == 'function'
+    assert graph['double_it'].arg_list == '(integer)'
+
+    # Windows line endings parse the same as Unix ones.
+    crlf_file = tmpdir.join('crlf.sql')
+    crlf_file.write_binary(SQL_FILE_CONTENTS.replace('\n', '\r\n').encode())
+    assert command.parse_file_statements(str(crlf_file)) == (
+        command.parse_file_statements(str(sql_file)))
+
+    empty_file = tmpdir.join('empty.sql')
+    empty_file.write('')
+    assert command.parse_file_statements(str(empty_file)) == []
+
+    # Large files are memory-mapped rather than read, with the same results.
+    large_file = tmpdir.join('large.sql')
+    large_file.write(SQL_FILE_CONTENTS + ';' + ' ' * (
+        room_with_a_view.MMAP_MIN_FILE_SIZE))
+    assert command.parse_file_statements(str(large_file)) == (
+        command.parse_file_statements(str(sql_file)))
+
+
+def test_parse_dependency_graph_cache(tmpdir, monkeypatch):
+    """Test that unchanged files are read from the parse cache."""
+    sql_directory = tmpdir.mkdir('sql')
+    sql_directory.join('views.sql').write(SQL_FILE_CONTENTS)
+    command = room_with_a_view.RoomWithAViewCommand()
+    command.directories = [str(sql_directory)]
+    command.cache_path = str(tmpdir.join('cache', 'parses.json'))
+    graph = command.parse_dependency_graph()
+
+    assert graph['big_orders'].out_edges == {'orders'}
+    assert graph['orders'].in_edges == ('big_orders',)
+
+    def fail_to_parse(filename):
+        raise AssertionError('{} should have been cached'.format(filename))
+    monkeypatch.setattr(command, 'parse_file_statements', fail_to_parse)
+    cached_graph = command.parse_dependency_graph()
+
+    assert sorted(cached_graph) == sorted(graph)
+    assert cached_graph['big_orders'].out_edges == {'orders'}
+
+    assert command.get_statements_from_file(
+        str(sql_directory.join('views.sql'))) == [
+            'orders', 'big_orders', 'double_it']
+
+    monkeypatch.undo()
+    sql_directory.join('views.sql').write(
+        'create view orders as select * from raw_orders;')
+    assert sorted(command.parse_dependency_graph()) == ['orders']
+
+
+class FakeCursor(object):
+    """A stand-in for a psycopg2 cursor that records executed SQL."""
+
+    def __init__(self, rows=()):
+        self.executed_sql = []
+        self.rows = list(rows)
+        self.rowcount = -1
+
+    def execute(self, sql_statement, parameters=None):
+        self.executed_sql.append(sql_statement)
+        self.rowcount = len(self.rows)
+
+    def fetchall(self):
+        return self.rows
+
+
+@pytest.fixture
+def command():
+    """A command with default options and a FakeCursor, but no connection."""
+    command = room_with_a_view.RoomWithAViewCommand()
+    command.options = argparse.Namespace(
+        view_names=[], file_names=[], verbosity=0,
+        batch_size=room_with_a_view.DEFAULT_SQL_BATCH_SIZE, dry_run=False)
+    command.cursor = FakeCursor()
+    return command
+
+
+def test_flush_sql_batches_statements(command, monkeypatch):
+    """Test that queued statements are sent in batches, in order."""
+    batches = []
+    monkeypatch.setattr(
+        psycopg2.extras, 'execute_batch',
+        lambda cursor, sql, argslist, page_size: batches.append(
+            [str(args[0]) for args in argslist]))
+    graph = build_graph({'a': [], 'b': ['a']})
+    for node in graph.values():
+        node.declaration = 'create view {} as '.format(node.name)
+        node.body = 'select 1'
+        command.drop_and_recreate_node(node)
+
+    assert batches == []
+    command.flush_sql()
+    assert batches == [[
+        'DROP VIEW IF EXISTS a CASCADE\n', 'create view a as select 1\n',
+        'DROP VIEW IF EXISTS b CASCADE\n', 'create view b as select 1\n',
+    ]]
+    assert command.pending_sql == []
+
+
+def test_flush_sql_trailing_comment(command, monkeypatch):
+    """Test that a body ending in a comment doesn't comment out the ';'."""
+    batches = []
+    monkeypatch.setattr(
+        psycopg2.extras, 'execute_batch',
+        lambda cursor, sql, argslist, page_size: batches.append(
+            ';'.join(str(args[0]) for args in argslist)))
+    command.queue_sql('create view a as\nselect * from t where active -- live')
+    command.queue_sql('create view b as select 1')
+    command.flush_sql()
+
+    assert batches == [
+        'create view a as\nselect * from t where active -- live\n;'
+        'create view b as select 1\n']
+
+
+def test_flush_sql_single_round_trip(command):
+    """Test that a batch size of 0 sends one multi-statement query."""
+    command.options.batch_size = 0
+    command.queue_sql('DROP VIEW IF EXISTS a CASCADE')
+    command.queue_sql('create view a as select 1 -- one')
+    command.queue_sql('create view b as select 2')
+    command.flush_sql()
+
+    assert command.cursor.executed_sql == [
+        'DROP VIEW IF EXISTS a CASCADE\n;\n'
+        'create view a as select 1 -- one\n;\n'
+        'create view b as select 2']
+
+
+def test_get_sql_filenames(tmpdir):
+    """Test finding .sql files in nested directories."""
+    tmpdir.join('a.sql').write('')
+    tmpdir.join('B.SQL').write('')
+    tmpdir.join('notes.txt').write('')
+    tmpdir.mkdir('nested').join('c.sql').write('')
+    command = room_with_a_view.RoomWithAViewCommand()
+    command.directories = [str(tmpdir), str(tmpdir.join('missing'))]
+
+    assert sorted(command.get_sql_filenames()) == sorted([
+        str(tmpdir.join('a.sql')), str(tmpdir.join('B.SQL')),
+        str(tmpdir.join('nested', 'c.sql'))])
+
+
+def test_flush_sql_dry_run(command, capsys):
+    """Test that a dry run prints queued statements instead of running them."""
+    command.options.verbosity = 2
+    command.options.dry_run = True
+    command.queue_sql('DROP VIEW IF EXISTS a CASCADE')
+    command.queue_sql('create view a as select 1 -- one')
+    command.flush_sql()
+
+    assert command.cursor.executed_sql == []
+    assert command.pending_sql == []
+    assert capsys.readouterr().out == (
+        'DROP VIEW IF EXISTS a CASCADE\n;\n'
+        'create view a as select 1 -- one\n;\n')
+
+
+def test_parse_file_quoted_semicolons(tmpdir):
+    """Test that quoted or commented-out ';'s don't end a statement."""
+    sql_file = tmpdir.join('views.sql')
+    sql_file.write('''
+create view labels as
+select 'a;b' as label, 'it''s' as quoted  -- don't stop here;
+from orders;
+
+create function f_clean (varchar)
+returns varchar stable as $$
+  # don't stop here either;
+  return s.strip(';')
+$$ language plpythonu;
+
+create view customers as
+select id as "customer's id", "a;b" from raw_customers;
+
+create view notes as
+/* don't touch; */ select 'hello' as greeting;
+
+create view after as select 1;
+''')
+    command = room_with_a_view.RoomWithAViewCommand()
+    statements = {
+        statement_data['name']: statement_data
+        for statement_data in command.parse_file_statements(str(sql_file))}
+
+    assert sorted(statements) == [
+        'after', 'customers', 'f_clean', 'labels', 'notes']
+    assert statements['customers']['body'] == (
+        '\nselect id as "customer\'s id", "a;b" from raw_customers')
+    assert statements['notes']['body'] == (
+        "\n/* don't touch; */ select 'hello' as greeting")
+    assert 'from orders' in statements['labels']['body']
+    assert "return s.strip(';')" in statements['f_clean']['body']
+    assert 'language plpythonu' in statements['f_clean']['body']
+
+
+def test_parse_file_dashed_comments(tmpdir):
+    """Test that long dashed comments without a create don't backtrack."""
+    sql_file = tmpdir.join('views.sql')
+    banner = '-- {}\n'.format('-' * 78)
+    sql_file.write(
+        'create view a as select 1;\n' + banner +
+        'grant select on a to analyst;\n' + banner +
+        banner + 'create view b as select 2;\n' + banner)
+    command = room_with_a_view.RoomWithAViewCommand()
+    statements = command.parse_file_statements(str(sql_file))
+
+    assert [statement_data['name'] for statement_data in statements] == [
+        'a', 'b']
+
+
+def test_parse_file_semicolons_in_comments(tmpdir):
+    """Test that ';'s in comments don't each start a new scan of the file."""
+    sql_file = tmpdir.join('views.sql')
+    sql_file.write(
+        'create view a as select 1;\n' + '-- note;\n' * 50000 +
+        "grant select on a to analyst;\ncreate view b as select 'open")
+    command = room_with_a_view.RoomWithAViewCommand()
+    statements = command.parse_file_statements(str(sql_file))
+
+    assert [statement_data['name'] for statement_data in statements] == [
+        'a', 'b']
+    assert statements[1]['body'] == " select 'open"
+
+
+def test_check_for_cycles():
+    """Test that a dependency cycle is reported with its path."""
+    command = room_with_a_view.RoomWithAViewCommand()
+    command.check_for_cycles(build_graph(DEPENDENCIES))
+
+    graph = build_graph({
+        'a': ['b'],
+        'b': ['c'],
+        'c': ['a'],
+        'd': ['a'],
+        'e': [],
+    })
+    with pytest.raises(ValueError) as error:
+        command.check_for_cycles(graph)
+    assert str(error.value).endswith('a -> b -> c -> a')
+
+
+def test_sync_views(command):
+    """Test that syncing a view recreates everything that depends on it."""
+    command.options.view_names = ['b']
+    command.dependency_graph = build_graph(DEPENDENCIES)
+    for node in command.dependency_graph.values():
+        node.declaration = 'create view {} as '.format(node.name)
+        node.body = 'select 1'
+    command.sync_views()
+
+    assert command.pending_sql == [
+        'DROP VIEW IF EXISTS b CASCADE',
+        'create view b as select 1',
+        'create view c as select 1',
+        'create view d as select 1',
+    ]
+
+    command.pending_sql = []
+    command.options.view_names = ['d', 'e']
+    command.sync_views()
+
+    assert command.pending_sql == [
+        'DROP VIEW IF EXISTS d CASCADE',
+        'create view d as select 1',
+        'DROP VIEW IF EXISTS e CASCADE',
+        'create view e as select 1',
+    ]
+
+
+def test_parse_statement_as_inside_identifiers():
+    """Test that 'as' inside an identifier doesn't end the declaration."""
+    command = room_with_a_view.RoomWithAViewCommand()
+    statement_data = command.parse_statement(
+        'create view last_orders (last_name, alias) as\n'
+        'select name, nickname from orders')
+
+    assert statement_data['name'] == 'last_orders'
+    assert statement_data['declaration'] == (
+        'create view last_orders (last_name, alias) as')
+    assert statement_data['body'] == '\nselect name, nickname from orders'
+
+
+def test_parse_statement_pathological_function():
+    """Test that a function with many parentheses parses in linear time."""
+    command = room_with_a_view.RoomWithAViewCommand()
+    statement = (
+        'create function f_path (numeric(18, 2))\nreturns numeric stable as $$'
+        + '\n  return (x)' * 20000 + '\n$$ language plpythonu')
+    statement_data = command.parse_statement(statement)
+    assert statement_data['name'] == 'f_path'
+    assert statement_data['arg_list'] == '(numeric(18, 2))'
+
+    statement_data = command.parse_statement(
+        'create function f_broken (' + '(x) ' * 20000)
+    assert statement_data['name'] is None
+
+
+def test_get_statements_from_arguments(command, tmpdir):
+    """Test that names from files are added without changing the options."""
+    sql_file = tmpdir.join('views.sql')
+    sql_file.write(SQL_FILE_CONTENTS)
+    command.options.view_names = ['double_it']
+    command.options.file_names = [str(sql_file)]
+    command.dependency_graph = build_graph(
+        {'orders': [], 'big_orders': ['orders'], 'double_it': []})
+
+    assert command.get_statements_from_arguments() == [
+        'double_it', 'orders', 'big_orders', 'double_it']
+    assert command.options.view_names == ['double_it']
+
+
+def test_drop_all_looks_up_functions_once(command):
+    """Test that existing functions are found with a single catalog query."""
+    command.cursor.rows = [('f_exists',)]
+    command.dependency_graph = build_graph(
+        {'f_exists': [], 'f_missing': [], 'v': []})
+    for name in ('f_exists', 'f_missing'):
+        command.dependency_graph[name].statement_type = 'function'
+        command.dependency_graph[name].arg_list = '(integer)'
+    command.drop_all()
+
+    assert command.cursor.executed_sql == [
+        'select proname from pg_proc where proname in %s']
+    assert command.pending_sql == [
+        'DROP FUNCTION f_exists (integer) CASCADE',
+        'DROP VIEW IF EXISTS v CASCADE',
+    ]
+
+
+def test_drop_views_duplicate_function(command):
+    """Test that a function named twice is only dropped once."""
+    command.options.view_names = ['f', 'f']
+    command.cursor.rows = [('f',)]
+    command.dependency_graph = build_graph({'f': []})
+    node = command.dependency_graph['f']
+    node.statement_type = 'function'
+    node.arg_list = '(integer)'
+    node.declaration = 'create function f (integer) returns integer as $$'
+    node.body = ' select 1 $$ language sql'
+    command.drop_views()
+
+    assert command.pending_sql == ['DROP FUNCTION f (integer) CASCADE']
+
+    # It no longer exists, so the first sync only creates it. Since it
+    # exists again after that, the second sync drops it before creating it.
+    command.pending_sql = []
+    command.sync_views()
+
+    assert command.pending_sql == [
+        'create function f (integer) returns integer as $$'
+        ' select 1 $$ language sql',
+        'DROP FUNCTION f (integer) CASCADE',
+        'create function f (integer) returns integer as $$'
+        ' select 1 $$ language sql',
+    ]
+
+
+def test_handle_single_round_trip(command, monkeypatch):
+    """Test that functions are looked up before any DDL is queued."""
+    class FakeConnection(object):
+        def cursor(self):
+            return command.cursor
+
+        def commit(self):
+            pass
+
+        def close(self):
+            pass
+
+    def parse_args():
+        command.options.action = 'drop-all'
+        command.options.batch_size = 0
+        command.conn = FakeConnection()
+
+    graph = build_graph({'v': [], 'f': []})
+    graph['f'].statement_type = 'function'
+    graph['f'].arg_list = '(integer)'
+    monkeypatch.setattr(command, 'parse_args', parse_args)
+    monkeypatch.setattr(command, 'parse_dependency_graph', lambda: graph)
+    command.cursor.rows = [('f',)]
+    command.handle()
+
+    assert command.cursor.executed_sql == [
+        'select proname from pg_proc where proname in %s',
+        'DROP VIEW IF EXISTS v CASCADE\n;\nDROP FUNCTION f (integer) CASCADE',
+    ]